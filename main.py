@@ -1,78 +1,598 @@
 from __future__ import annotations
 
-import json
+import asyncio
+import gzip
+import hashlib
+import itertools
+import logging
+import math
+import os
 import time
+from collections import Counter, defaultdict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from dataclasses import dataclass
-from functools import lru_cache
-from typing import Any, Dict, Optional, Tuple
-
-import requests
-from fastapi import FastAPI, Query
-from fastapi.responses import HTMLResponse, JSONResponse
-
-
-app = FastAPI(title="SmallBiz Map Hover MVP")
+from functools import wraps
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+import diskcache
+import httpx
+import msgspec
+import orjson
+import redis.asyncio as aioredis
+from fastapi import FastAPI, Query, Request
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
+
+
+logger = logging.getLogger(__name__)
+
+# 全局复用一个 AsyncClient：连接池 + keep-alive，所有外部源都走它（TLS 只握手一次）
+# 支持 HTTP/2 的上游会把同一 host 的并发请求复用在一条连接上；不支持的自动走 HTTP/1.1
+# transport 层 retries 只重试建连失败；5xx 重试见 request_json
+_client = httpx.AsyncClient(
+    timeout=25,
+    headers={"User-Agent": "smallbiz-platform/1.0 (hover-mvp)"},
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=2,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+    ),
+)
+
+# 网关类错误多半是上游瞬时过载，退避后重试
+_RETRY_STATUSES = {502, 503, 504}
+_MAX_RETRIES = 2
+_RETRY_BACKOFF_SEC = 0.3
+
+# 跨 worker / 跨重启共享的缓存；没配 REDIS_URL 时只用进程内缓存
+_redis = aioredis.Redis.from_url(os.environ["REDIS_URL"]) if os.environ.get("REDIS_URL") else None
+# 没配 Redis 时，基本不变的数据源（census / ACS）落本地磁盘，重启后不必重新回源
+_disk = (
+    diskcache.Cache(os.environ.get("SMALLBIZ_CACHE_DIR", str(Path(__file__).parent / ".cache")))
+    if _redis is None
+    else None
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    background = [
+        asyncio.create_task(_refresh_index_forever("crime", _load_crime_index, _CRIME_REFRESH_SEC)),
+        asyncio.create_task(_refresh_index_forever("poi", _load_poi_index, _POI_REFRESH_SEC)),
+        asyncio.create_task(_warm_tiles()),
+    ]
+    yield
+    for task in background:
+        task.cancel()
+    await _client.aclose()
+    if _redis is not None:
+        await _redis.aclose()
+    if _disk is not None:
+        _disk.close()
+
+
+class ORJSONResponse(JSONResponse):
+    # orjson 直接输出 bytes，比标准库 json 编码快得多
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+
+app = FastAPI(title="SmallBiz Map Hover MVP", lifespan=lifespan, default_response_class=ORJSONResponse)
+# hover 每秒最多几次请求，JSON 压缩后体积能降一大半；小响应不值得压
+app.add_middleware(GZipMiddleware, minimum_size=512)
 
 
 # -----------------------------
 # Basic helpers
 # -----------------------------
 class ApiError(RuntimeError):
-    pass
+    def __init__(self, message: str, status: Optional[int] = None) -> None:
+        super().__init__(message)
+        self.status = status  # 上游 HTTP 状态码（有的话）
+
+
+class _PrefetchSkipped(ApiError):
+    """预取时限流器没有空闲额度，放弃这次回源。"""
+
+
+def _etag(content: bytes) -> str:
+    # 弱 ETag（W/"内容哈希"）：同一份内容可能原样发、也可能被 gzip 后发，
+    # 字节不同的两种编码不能共用同一个强校验值
+    return 'W/"' + hashlib.blake2b(content, digest_size=16).hexdigest() + '"'
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    # If-None-Match 用弱比较：可能是逗号分隔的多个值，忽略 W/ 前缀
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip() == "*" or tag.strip().removeprefix("W/") == opaque for tag in header.split(","))
 
 
 @dataclass
 class RateLimiter:
     calls: int
     period_sec: float
-    _timestamps: Optional[list[float]] = None
+    _timestamps: Optional[deque[float]] = None
+    _lock: Optional[asyncio.Lock] = None
 
     def __post_init__(self) -> None:
-        self._timestamps = []
+        # 只需要最近 calls 次的时间戳：定长环形缓冲，append 自动挤掉最老的一个，不用再清理
+        self._timestamps = deque(maxlen=self.calls)
+        # 检查 + 等待 + 记账必须原子，否则并发协程会同时看到同一个空位一起冲过去
+        self._lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        # 在事件循环里不能 time.sleep，否则会卡住所有并发中的 hover 请求
+        # 缓冲满时，队头就是倒数第 calls 次调用：它离现在不足 period_sec 就得等；monotonic 不受系统校时影响
+        async with self._lock:
+            if len(self._timestamps) == self.calls:
+                sleep_for = self.period_sec - (time.monotonic() - self._timestamps[0])
+                if sleep_for > 0:
+                    await asyncio.sleep(sleep_for)
+            self._timestamps.append(time.monotonic())
+
+    def idle(self) -> bool:
+        """现在调用 wait() 是否不用等（不占额度，只是看一眼）。"""
+        if self._lock.locked():  # 已经有人在排队等额度
+            return False
+        return len(self._timestamps) < self.calls or time.monotonic() - self._timestamps[0] >= self.period_sec
+
+    def try_acquire(self, reserve: int = 0) -> bool:
+        """
+        不等待：当前窗口里用掉的次数 + reserve 还没到 calls 就占一个并返回 True，否则返回 False（不排队）。
+        reserve 是留给别人的余量：预取只用得到窗口的一部分，下一个真实 hover 到来时仍有空位。
+        """
+        if self._lock.locked():
+            return False
+        now = time.monotonic()
+        used = sum(1 for ts in self._timestamps if now - ts < self.period_sec)
+        if used + reserve >= self.calls:
+            return False
+        self._timestamps.append(now)
+        return True
+
+
+_MISSING = object()
+
+# 当前协程是否在做邻格预取；预取写入的缓存条目优先被淘汰
+_prefetching: ContextVar[bool] = ContextVar("prefetching", default=False)
+
+
+# 开了 max_bytes 的缓存里，单个条目最多占总预算的这个比例，再大就不缓存
+_MAX_ENTRY_FRACTION = 0.125
+
+
+def _sizeof(value: Any) -> int:
+    # 缓存条目大小的估算：bytes 取长度，bytes 组成的 tuple 逐个相加，其余按序列化后的长度
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, tuple):
+        return sum(_sizeof(v) for v in value)
+    return len(orjson.dumps(value))
+
+
+class AsyncTTLCache:
+    """
+    给 async 数据源用的进程内缓存：CLOCK 淘汰 + 过期时间，get/set 都是 O(1)。
+    命中只置一个引用位，不像 LRU 那样每次都要重排链表；满了要腾位置时指针绕圈，
+    沿途清掉引用位，第一个引用位已是 0 的条目出局（"第二次机会"）。
+    ttl=None 表示永不过期（只按容量淘汰）。
+    max_bytes 给了的话再按总字节数封顶：各地块结果大小差几个数量级（空网格 vs 市中心），
+    只按条数限不住内存。条目大小按 _sizeof 估算，只在写入时算一次。
+    未命中时同一个 key 只回源一次（single-flight）：并发到达的请求共享同一个 in-flight task。
+    过期条目不立即删除（直到被淘汰或覆盖），上游超时时可用 get_stale 兜底。
+    预取写入的条目（low_priority）引用位为 0，指针下次经过就被淘汰，先于用户真实 hover 过的条目；
+    之后被 get 命中一次就按普通条目对待。
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None, max_bytes: Optional[int] = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._data: Dict[Any, Tuple[int, float, Any, int]] = {}  # key -> (槽位, expires_at, value, 字节数)
+        self._slots: List[Any] = []  # 环：槽位 -> key；空槽为 _MISSING
+        self._ref = bytearray()  # 每个槽位的引用位
+        self._free: List[int] = []  # 按字节淘汰腾出来的空槽
+        self._hand = 0
+        self._inflight: Dict[Any, asyncio.Task] = {}
+        self._waiters: Counter = Counter()
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        item = self._data.get(key, _MISSING)
+        if item is _MISSING:
+            return default
+        slot, expires_at, value, _ = item
+        if expires_at < time.monotonic():
+            return default
+        self._ref[slot] = 1
+        return value
+
+    def get_stale(self, key: Any, default: Any = None) -> Any:
+        """不管是否过期，返回最后一次写入的值。"""
+        item = self._data.get(key, _MISSING)
+        return default if item is _MISSING else item[2]
+
+    def __contains__(self, key: Any) -> bool:
+        # 只看是否有未过期的值，不置引用位（预取前的检查不应把条目"续命"）
+        item = self._data.get(key, _MISSING)
+        return item is not _MISSING and item[1] >= time.monotonic()
+
+    def set(self, key: Any, value: Any, low_priority: bool = False) -> None:
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else float("inf")
+        size = _sizeof(value)
+        item = self._data.get(key, _MISSING)
+        if self.max_bytes is not None and size > self.max_bytes * _MAX_ENTRY_FRACTION:
+            # 准入：单个条目超过总预算的一定比例就不存，免得为它清空半个缓存；旧值也作废
+            if item is not _MISSING:
+                del self._data[key]
+                self._slots[item[0]] = _MISSING
+                self._free.append(item[0])
+                self.total_bytes -= item[3]
+            return
+        if item is not _MISSING:
+            slot = item[0]
+            self.total_bytes -= item[3]
+        elif self._free:
+            slot = self._free.pop()
+        elif len(self._slots) < self.maxsize:
+            slot = len(self._slots)
+            self._slots.append(_MISSING)
+            self._ref.append(0)
+        else:
+            slot = self._evict()
+        self._slots[slot] = key
+        self._data[key] = (slot, expires_at, value, size)
+        self._ref[slot] = 0 if low_priority else 1
+        self.total_bytes += size
+
+        if self.max_bytes is not None:
+            while self.total_bytes > self.max_bytes:
+                self._free.append(self._evict())
+
+    def _evict(self) -> int:
+        """指针绕圈，淘汰第一个引用位为 0 的条目，返回腾出的槽位。"""
+        while True:
+            slot = self._hand
+            self._hand = (self._hand + 1) % len(self._slots)
+            key = self._slots[slot]
+            if key is _MISSING:
+                continue
+            if self._ref[slot]:
+                self._ref[slot] = 0
+                continue
+            self.total_bytes -= self._data.pop(key)[3]
+            self._slots[slot] = _MISSING
+            return slot
+
+    async def get_or_fetch(self, key: Any, fetch) -> Any:
+        """
+        命中直接返回；否则 await 同 key 的 in-flight task，没有就用 fetch() 新建一个。
+        回源 + 写缓存在独立 task 里跑，调用方通过 shield 等待：某个调用方被取消不会打断其他人的回源。
+        最后一个等待者也被取消（客户端断开，没人要这个结果了）时才取消回源，让出连接和限流额度。
+        异常不缓存，所有等待者都会收到；例外是前台请求接上了一次因限流器忙而放弃的预取，这时自己重新回源。
+        """
+        while True:
+            value = self.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+
+            task = self._inflight.get(key)
+            if task is None:
+                task = asyncio.ensure_future(self._fill(key, fetch))
+                self._inflight[key] = task
+                task.add_done_callback(lambda t: self._done(key, t))
+            self._waiters[key] += 1
+            try:
+                return await asyncio.shield(task)
+            except _PrefetchSkipped:
+                if _prefetching.get():
+                    raise
+            except asyncio.CancelledError:
+                if self._waiters[key] == 1:
+                    task.cancel()
+                    self._inflight.pop(key, None)  # 之后到达的请求重新回源，不要接上这个正在取消的 task
+                raise
+            finally:
+                self._waiters[key] -= 1
+                if not self._waiters[key]:
+                    del self._waiters[key]
+
+    async def _fill(self, key: Any, fetch) -> Any:
+        value = await fetch()
+        self.set(key, value, low_priority=_prefetching.get())
+        return value
+
+    def _done(self, key: Any, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # 标记已取走，避免所有调用方都放弃时打出 "never retrieved" 警告
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+def async_cached(maxsize: int, ttl: Optional[float] = None, max_bytes: Optional[int] = None):
+    """
+    给 async 数据源函数加 AsyncTTLCache（按位置参数做 key）。
+    functools.lru_cache 不能用于 async def（缓存的是协程对象而不是结果）。
+    wrapper.cache 是底层缓存；wrapper.stale(*args) 返回最后一次的值（可能已过期），没有则返回 _MISSING。
+    单进程内去重；跨 worker 共享靠 Redis 层。
+    """
+    def deco(fn):
+        cache = AsyncTTLCache(maxsize, ttl, max_bytes)
+
+        @wraps(fn)
+        async def wrapper(*args):
+            return await cache.get_or_fetch(args, lambda: fn(*args))
+
+        wrapper.cache = cache
+        wrapper.stale = lambda *args: cache.get_stale(args, _MISSING)
+        return wrapper
+
+    return deco
+
+
+def shared_cached(prefix: str, ttl: int, persistent: bool = False):
+    """
+    进程外缓存层，key 形如 "poi:39.29:-76.612:500"。
+    配了 Redis 就用 Redis（所有 worker 共享）；否则 persistent=True 的数据源落本地磁盘（diskcache），
+    其余只靠进程内缓存。缓存后端出错时直接回源，不影响请求本身。
+    """
+    def deco(fn):
+        @wraps(fn)
+        async def wrapper(*args):
+            if _redis is None and not (persistent and _disk is not None):
+                return await fn(*args)
+
+            key = ":".join([prefix, *map(str, args)])
+            try:
+                if _redis is not None:
+                    cached = await _redis.get(key)
+                else:
+                    cached = await asyncio.to_thread(_disk.get, key)
+            except Exception as e:
+                logger.warning("cache get %s failed: %s", key, e)
+                cached = None
+            if cached is not None:
+                return orjson.loads(cached)
+
+            value = await fn(*args)
+            try:
+                if _redis is not None:
+                    await _redis.setex(key, ttl, orjson.dumps(value))
+                else:
+                    await asyncio.to_thread(_disk.set, key, orjson.dumps(value), expire=ttl)
+            except Exception as e:
+                logger.warning("cache set %s failed: %s", key, e)
+            return value
+
+        return wrapper
+
+    return deco
+
+
+_EARTH_RADIUS_M = 6371008.8
+_M_PER_DEG_LAT = 111320.0
+
+
+def _haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * _EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+class PointIndex:
+    """
+    内存点索引：按 cell_deg 均匀网格分桶，半径查询只扫覆盖到的格子，
+    再用 haversine 精确过滤。每个点带一个 tag（例如 CRIME_TYPE）。
+    """
+
+    def __init__(self, points: Iterable[Tuple[float, float, str]], cell_deg: float = 0.01) -> None:
+        self.cell_deg = cell_deg
+        self._cells: Dict[Tuple[int, int], List[Tuple[float, float, str]]] = defaultdict(list)
+        self.size = 0
+        for lat, lon, tag in points:
+            self._cells[self._cell(lat, lon)].append((lat, lon, tag))
+            self.size += 1
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg)
+
+    def query(self, lat: float, lon: float, radius_m: float) -> List[str]:
+        """返回半径内所有点的 tag。"""
+        dlat = radius_m / _M_PER_DEG_LAT
+        dlon = radius_m / (_M_PER_DEG_LAT * max(math.cos(math.radians(lat)), 1e-6))
+        i0, j0 = self._cell(lat - dlat, lon - dlon)
+        i1, j1 = self._cell(lat + dlat, lon + dlon)
+
+        hits = []
+        for i in range(i0, i1 + 1):
+            for j in range(j0, j1 + 1):
+                for plat, plon, tag in self._cells.get((i, j), ()):
+                    if _haversine_m(lat, lon, plat, plon) <= radius_m:
+                        hits.append(tag)
+        return hits
+
+
+# bbox 统一用 (south, west, north, east)
+# 支持的大都会区（Baltimore 及周边）；范围外 Census 等全国接口多半是慢速失败，直接短路
+_METRO_BBOX = (38.5, -77.5, 40.0, -75.5)
+# Baltimore 市界外包框：警方犯罪图层、POI 本地快照都只覆盖这里
+_BALTIMORE_CITY_BBOX = (39.197, -76.712, 39.372, -76.529)
+
+
+def _bbox_contains(bbox: Tuple[float, float, float, float], lat: float, lon: float) -> bool:
+    south, west, north, east = bbox
+    return south <= lat <= north and west <= lon <= east
+
 
-    def wait(self) -> None:
-        now = time.time()
-        self._timestamps = [t for t in self._timestamps if now - t < self.period_sec]
-        if len(self._timestamps) >= self.calls:
-            sleep_for = self.period_sec - (now - self._timestamps[0])
-            if sleep_for > 0:
-                time.sleep(sleep_for)
-        self._timestamps.append(time.time())
+def _bbox_covers(bbox: Tuple[float, float, float, float], lat: float, lon: float, radius_m: float) -> bool:
+    """判断整个查询圆是否落在 bbox 内。"""
+    south, west, north, east = bbox
+    dlat = radius_m / _M_PER_DEG_LAT
+    dlon = radius_m / (_M_PER_DEG_LAT * max(math.cos(math.radians(lat)), 1e-6))
+    return south <= lat - dlat and lat + dlat <= north and west <= lon - dlon and lon + dlon <= east
 
 
-def _round_key(lat: float, lon: float, ndigits: int = 3) -> Tuple[float, float]:
-    # 3 位小数约 110m 网格，hover 模式必须网格化避免请求爆炸
-    return round(lat, ndigits), round(lon, ndigits)
+def _bbox_touches(bbox: Tuple[float, float, float, float], lat: float, lon: float, radius_m: float) -> bool:
+    """查询圆是否可能与 bbox 相交（按圆的外接框判断，偏保守）。"""
+    south, west, north, east = bbox
+    dlat = radius_m / _M_PER_DEG_LAT
+    dlon = radius_m / (_M_PER_DEG_LAT * max(math.cos(math.radians(lat)), 1e-6))
+    return lat + dlat >= south and lat - dlat <= north and lon + dlon >= west and lon - dlon <= east
 
 
-def request_json(
+# 后台定期刷新的本地快照索引，name -> PointIndex；加载完成之前各数据源走远端查询
+_indexes: Dict[str, PointIndex] = {}
+
+
+# 快照加载失败后按指数退避重试（从 30 秒起，封顶到正常刷新周期），不要白等一整个周期
+_INDEX_RETRY_SEC = 30
+
+
+async def _refresh_index_forever(name: str, loader, period_sec: float) -> None:
+    retry_sec = _INDEX_RETRY_SEC
+    while True:
+        try:
+            index = await loader()
+            # 空快照几乎一定是上游出了问题（报错 / 截断），不能当成"这里什么都没有"：
+            # 保留之前的索引；一直没加载成功时查询会回退到远端
+            if index.size == 0:
+                raise ApiError("empty snapshot")
+            _indexes[name] = index
+            logger.info("%s index loaded: %d points", name, index.size)
+        except Exception as e:
+            logger.warning("%s index refresh failed, retrying in %ds: %s", name, retry_sec, e)
+            await asyncio.sleep(retry_sec)
+            retry_sec = min(retry_sec * 2, period_sec)
+            continue
+        retry_sec = _INDEX_RETRY_SEC
+        await asyncio.sleep(period_sec)
+
+
+_EARTH_CIRCUMFERENCE_M = 40075016.686
+_MAX_GRID_ZOOM = 20
+
+
+def _grid_zoom(lat: float, radius_m: int) -> int:
+    # 瓦片边长约 radius/5（向粗取整）：Baltimore 纬度下 r=500 -> z18(~117m)，r=1000 -> z17，r=2000 -> z16(~470m)
+    tile_m = _EARTH_CIRCUMFERENCE_M * math.cos(math.radians(lat))
+    return min(_MAX_GRID_ZOOM, math.floor(math.log2(tile_m * 5 / radius_m)))
+
+
+def _grid_cell(lat: float, lon: float, radius_m: int = 500) -> Tuple[int, int, int]:
+    """坐标所在的 slippy map 瓦片 (z, x, y)，z 随半径变化。"""
+    z = _grid_zoom(lat, radius_m)
+    n = 2 ** z
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return z, min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def _tile_center(z: int, x: int, y: int) -> Tuple[float, float]:
+    n = 2 ** z
+    lon = (x + 0.5) / n * 360.0 - 180.0
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 0.5) / n))))
+    return round(lat, 6), round(lon, 6)
+
+
+def _round_key(lat: float, lon: float, radius_m: int = 500) -> Tuple[float, float]:
+    # hover 模式必须网格化避免请求爆炸：吸附到所在瓦片的中心点。
+    # 瓦片在当地东西、南北两个方向上边长一致，不像按经纬度小数位取整那样经度格子随纬度变窄
+    return _tile_center(*_grid_cell(lat, lon, radius_m))
+
+
+# 半径分桶的公比：桶是以 500m 为锚的等比数列 …, 455, 500, 550, 605, …
+# 实际查询半径与请求半径相差不超过约 5%（面积约 10%），误差按比例封顶，不随半径放大
+_RADIUS_BUCKET_RATIO = 1.1
+
+
+def _radius_bucket(radius_m: int) -> int:
+    # 半径也分桶，相近半径共享缓存：480 / 520 都算 500
+    n = round(math.log(radius_m / 500) / math.log(_RADIUS_BUCKET_RATIO))
+    return int(round(500 * _RADIUS_BUCKET_RATIO ** n))
+
+
+async def request_json(
     method: str,
     url: str,
     params: Optional[Dict[str, Any]] = None,
     data: Optional[bytes] = None,
     timeout: float = 25,
     limiter: Optional[RateLimiter] = None,
-) -> Dict[str, Any]:
-    if limiter:
-        limiter.wait()
+    decode_as: Optional[type] = None,
+) -> Any:
+    """
+    decode_as 给了 msgspec.Struct 类型时直接按类型解码（不建中间 dict，只取声明了的字段），
+    否则 orjson 解成普通 dict / list。
+    """
+    for attempt in range(_MAX_RETRIES + 1):
+        if limiter:
+            # 预取只用限流器的空闲额度，且至少给前台留一半：真正发请求这一刻没空位就放弃，绝不排队
+            if _prefetching.get():
+                if not limiter.try_acquire(reserve=(limiter.calls + 1) // 2):
+                    raise _PrefetchSkipped("rate limiter busy, prefetch skipped")
+            else:
+                await limiter.wait()
+        r = await _client.request(method, url, params=params, content=data, timeout=timeout)
+        if r.status_code not in _RETRY_STATUSES or attempt == _MAX_RETRIES:
+            break
+        await asyncio.sleep(_RETRY_BACKOFF_SEC * 2 ** attempt)
 
-    headers = {"User-Agent": "smallbiz-platform/1.0 (hover-mvp)"}
-    r = requests.request(method, url, params=params, data=data, timeout=timeout, headers=headers)
     if r.status_code >= 400:
-        raise ApiError(f"HTTP {r.status_code}: {r.text[:200]}")
+        raise ApiError(f"HTTP {r.status_code}: {r.text[:200]}", status=r.status_code)
     try:
-        return r.json()
+        if decode_as is not None:
+            return msgspec.json.decode(r.content, type=decode_as)
+        return orjson.loads(r.content)
+    except msgspec.ValidationError as e:
+        raise ApiError(f"Unexpected response shape: {e} | body={r.text[:200]}")
     except Exception as e:
         raise ApiError(f"Non-JSON response: {str(e)[:120]} | body={r.text[:200]}")
 
 
-def safe_call(fn, default):
+_detached: set[asyncio.Task] = set()
+
+
+def _detach(task: asyncio.Task) -> asyncio.Task:
+    """让 task 在后台跑完：事件循环只持有弱引用，要自己留着，否则可能跑到一半被 GC。"""
+    _detached.add(task)
+    task.add_done_callback(_detached.discard)
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    return task
+
+
+async def safe_call(fn, default, timeout: Optional[float] = None, stale=None):
     """
     任何外部源失败都不让 /api/features 500；
-    返回 (value, note). note 为 None 表示成功。
+    fn 返回 awaitable；返回 (value, note). note 为 None 表示成功。
+    timeout: 超时就不等了，但回源留在后台跑完、照样写缓存（只有调用方被取消时才一起取消）；
+    stale() 能给出旧值（非 _MISSING）时用旧值兜底，否则返回 default。
     """
     try:
-        return fn(), None
+        if timeout is None:
+            return await fn(), None
+        task = asyncio.ensure_future(fn())
+        try:
+            done, _ = await asyncio.wait({task}, timeout=timeout)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        if not done:
+            _detach(task)
+            value = stale() if stale is not None else _MISSING
+            if value is not _MISSING:
+                return value, "timeout, serving stale"
+            return default, f"TimeoutError: no response within {timeout}s"
+        return task.result(), None
     except Exception as e:
         return default, f"{type(e).__name__}: {str(e)[:180]}"
 
@@ -83,8 +603,9 @@ def safe_call(fn, default):
 _census_limiter = RateLimiter(calls=8, period_sec=1.0)
 
 
-@lru_cache(maxsize=20000)
-def census_geographies(lat_key: float, lon_key: float) -> Dict[str, str]:
+@async_cached(maxsize=20000, ttl=30 * 86400)  # tract 边界十年一变
+@shared_cached("census_geo", ttl=30 * 86400, persistent=True)
+async def census_geographies(lat_key: float, lon_key: float) -> Dict[str, str]:
     """
     给定坐标（网格化后），返回 state/county/tract FIPS.
     """
@@ -96,7 +617,7 @@ def census_geographies(lat_key: float, lon_key: float) -> Dict[str, str]:
         "vintage": "Current_Current",
         "format": "json",
     }
-    data = request_json("GET", url, params=params, timeout=20, limiter=_census_limiter)
+    data = await request_json("GET", url, params=params, timeout=20, limiter=_census_limiter)
 
     geos = (data.get("result") or {}).get("geographies") or {}
     try:
@@ -116,77 +637,209 @@ def census_geographies(lat_key: float, lon_key: float) -> Dict[str, str]:
 # B) ACS: tract -> income/pop
 # -----------------------------
 _acs_limiter = RateLimiter(calls=8, period_sec=1.0)
+_ACS_YEAR = 2022
 
 
-@lru_cache(maxsize=20000)
-def acs_features(state_fips: str, county_fips: str, tract: str) -> Dict[str, Any]:
+class ACSRow(msgspec.Struct, array_like=True):
+    # ACS 把数值都以字符串返回，缺值为 null；strict=False 时 msgspec 直接转成 int
+    # 响应列顺序 = 请求 get= 的顺序（由字段顺序生成），按位置解码；末尾的 state/county/tract 列忽略
+    B19013_001E: Optional[int] = None  # median household income
+    B01003_001E: Optional[int] = None  # total population
+
+
+_ACS_GET = ",".join(ACSRow.__struct_fields__)
+
+
+@async_cached(maxsize=20000, ttl=30 * 86400)  # ACS 年份固定
+@shared_cached(f"acs{_ACS_YEAR}", ttl=7 * 86400, persistent=True)  # key 带年份，换年份自然失效
+async def acs_features(state_fips: str, county_fips: str, tract: str) -> Dict[str, Any]:
     """
-    ACS 5-year. 这里用 2022 做示例；你后面需要更新年份只改这里一行即可。
+    ACS 5-year. 这里用 2022 做示例；你后面需要更新年份只改 _ACS_YEAR 一行即可。
     """
-    url = "https://api.census.gov/data/2022/acs/acs5"
+    url = f"https://api.census.gov/data/{_ACS_YEAR}/acs/acs5"
     params = {
-        "get": "B19013_001E,B01003_001E",  # median household income, total population
+        "get": _ACS_GET,
         "for": f"tract:{tract}",
         "in": f"state:{state_fips} county:{county_fips}",
     }
-    data = request_json("GET", url, params=params, timeout=20, limiter=_acs_limiter)
-
-    cols = data[0]
-    vals = data[1]
-    row = dict(zip(cols, vals))
+    data = await request_json("GET", url, params=params, timeout=20, limiter=_acs_limiter)
 
-    def to_int(x: str) -> Optional[int]:
-        try:
-            return int(x)
-        except Exception:
-            return None
+    vals = data[1]  # data[0] 是表头
+    try:
+        row = msgspec.convert(vals, ACSRow, strict=False)
+    except msgspec.ValidationError as e:
+        raise ApiError(f"Unexpected ACS row: {e} | row={vals}")
 
     return {
-        "population": to_int(row.get("B01003_001E", "")),
-        "median_household_income": to_int(row.get("B19013_001E", "")),
+        "population": row.B01003_001E,
+        "median_household_income": row.B19013_001E,
     }
 
 
 # -----------------------------
 # C) Overpass: POI counts within radius
 # -----------------------------
-_overpass_limiter = RateLimiter(calls=2, period_sec=1.0)  # 保守，避免 Overpass 压力过大
+# 公共 Overpass 实例各自限并发槽位；轮流用几个全球数据的镜像，每个镜像单独限流（保守，避免压力过大）
+# （overpass.osm.ch 之类只有局部数据的实例不能放进来，Baltimore 会查出 0）
+_OVERPASS_MIRRORS = (
+    "https://overpass-api.de/api/interpreter",
+    "https://overpass.kumi.systems/api/interpreter",
+    "https://overpass.private.coffee/api/interpreter",
+)
+_overpass_limiters = {url: RateLimiter(calls=2, period_sec=1.0) for url in _OVERPASS_MIRRORS}
+_overpass_turn = itertools.count()
+# 这些状态说明是该镜像忙 / 限流，换下一个镜像
+_OVERPASS_FAILOVER_STATUSES = {429, 502, 503, 504}
+_POI_REFRESH_SEC = 7 * 86400
+
+# 本地快照覆盖的范围；查询圆超出范围时走 Overpass
+_POI_SNAPSHOT_BBOX = _BALTIMORE_CITY_BBOX
+
+# 输出字段名（同时用作 set 名）, OSM tag key, tag value（None 表示只要有这个 key）
+_POI_CATEGORIES = (
+    ("restaurants", "amenity", "restaurant"),
+    ("bars", "amenity", "bar"),
+    ("cafes", "amenity", "cafe"),
+    ("shops", "shop", None),
+)
+
+
+class OverpassCenter(msgspec.Struct):
+    lat: float
+    lon: float
+
+
+class OverpassElement(msgspec.Struct):
+    # node 直接带 lat/lon；way / relation 用 `out center` 时坐标在 center 里；`out count` 的元素 type=count
+    type: str
+    lat: Optional[float] = None
+    lon: Optional[float] = None
+    center: Optional[OverpassCenter] = None
+    tags: Dict[str, str] = {}
+
+
+class OverpassResponse(msgspec.Struct):
+    elements: List[OverpassElement] = []
+    # 查询超时 / 内存超限时 Overpass 仍回 HTTP 200，elements 不完整，错误写在 remark 里
+    remark: Optional[str] = None
+
+
+async def overpass_query(query: str, timeout: float) -> OverpassResponse:
+    """
+    从轮到的镜像开始发查询；镜像限流 / 过载 / 连不上就换下一个，全部失败才抛最后一个错误。
+    """
+    start = next(_overpass_turn)
+    error: Exception = ApiError("no Overpass mirror configured")
+    for i in range(len(_OVERPASS_MIRRORS)):
+        url = _OVERPASS_MIRRORS[(start + i) % len(_OVERPASS_MIRRORS)]
+        try:
+            data = await request_json(
+                "POST", url, data=query.encode("utf-8"), timeout=timeout,
+                limiter=_overpass_limiters[url], decode_as=OverpassResponse,
+            )
+        except ApiError as e:
+            if e.status not in _OVERPASS_FAILOVER_STATUSES:
+                raise
+            error = e
+        except httpx.TransportError as e:
+            error = e
+        else:
+            if data.remark is not None:
+                raise ApiError(f"Overpass runtime error: {data.remark[:200]}")
+            return data
+        logger.warning("overpass mirror %s failed, trying next: %s", url, error)
+    raise error
+
+
+def _poi_filter(key: str, value: Optional[str]) -> str:
+    """
+    filter_expr 要写成 Overpass 支持的表达式，例如:
+      '"amenity"="restaurant"'  ->  node(...)[ "amenity"="restaurant" ]
+      'shop'                    ->  node(...)[ shop ]
+    """
+    return f'"{key}"="{value}"' if value is not None else key
+
+
+def _poi_scan_filters() -> List[Tuple[str, str]]:
+    """
+    按 tag key 合并各类的过滤条件，返回 [(key, filter_expr)]：
+    同一个 key 的多个取值合成一条正则（amenity~"^(restaurant|bar|cafe)$"），
+    有类别只要求 key 存在时（shop）就只按 key 过滤。空间扫描次数 = key 的个数。
+    """
+    values_by_key: Dict[str, List[Optional[str]]] = {}
+    for _, key, value in _POI_CATEGORIES:
+        values_by_key.setdefault(key, []).append(value)
+    filters = []
+    for key, values in values_by_key.items():
+        if None in values:
+            filters.append((key, key))
+        else:
+            filters.append((key, f'"{key}"~"^({"|".join(values)})$"'))
+    return filters
+
+
+# 实时计数查询只有 around 子句随请求变化，其余部分启动时拼好一次
+_POI_COUNT_QUERY = (
+    "[out:json][timeout:25];"
+    + "".join(f"nwr({{around}})[{filter_expr}]->.{key};" for key, filter_expr in _poi_scan_filters())
+    + "".join(
+        f"nwr.{key}[{_poi_filter(key, value)}]->.{name};.{name} out count;"
+        for name, key, value in _POI_CATEGORIES
+    )
+)
 
 
-@lru_cache(maxsize=20000)
-def poi_counts(lat_key: float, lon_key: float, radius_m: int) -> Dict[str, Any]:
+async def _load_poi_index() -> PointIndex:
+    """
+    一次 bbox 查询拉下快照范围内四类 POI（way/relation 取中心点），建本地索引。
+    一个元素同时属于多类时（例如 cafe 且带 shop=*），每类各记一次，与逐类计数口径一致。
+    """
+    south, west, north, east = _POI_SNAPSHOT_BBOX
+    bbox = f"{south},{west},{north},{east}"
+    stmts = "".join(f"nwr[{filter_expr}]({bbox});" for _, filter_expr in _poi_scan_filters())
+    # node 用默认输出（坐标 + tags）；way / relation 只要 tags + 中心点，
+    # 不要 node 引用列表 / members，这两项占了响应体的大头，解析出来也用不上
+    query = f"[out:json][timeout:180];({stmts})->.p;node.p;out;(way.p;relation.p;);out tags center;"
+    data = await overpass_query(query, timeout=240)
+
+    points: List[Tuple[float, float, str]] = []
+    for e in data.elements:
+        c = e.center or e
+        if c.lat is None or c.lon is None:
+            continue
+        for name, k, v in _POI_CATEGORIES:
+            if k in e.tags and (v is None or e.tags[k] == v):
+                points.append((c.lat, c.lon, name))
+
+    return await asyncio.to_thread(PointIndex, points)
+
+
+@async_cached(maxsize=20000, ttl=3600)
+@shared_cached("poi", ttl=3600)
+async def poi_counts(lat_key: float, lon_key: float, radius_m: int) -> Dict[str, Any]:
     """
     周边 POI 密度（按类计数）。
-    关键：filter_expr 要写成 Overpass 支持的表达式，例如:
-      '"amenity"="restaurant"'  ->  node(...)[ "amenity"="restaurant" ]
-      'shop'                    ->  node(...)[ shop ]
+    查询圆在本地快照范围内时直接查内存索引；否则四类合并成一条 Overpass 查询，
+    一次往返、只占一个限流名额：
+      - 每个 tag key 只做一次 around 扫描（nwr = node/way/relation），结果存成以 key 命名的 set；
+      - 每类再从对应 set 里按取值筛出来 `out count;`，不传任何元素本身。
     """
-    overpass_url = "https://overpass-api.de/api/interpreter"
-
-    def count_for(filter_expr: str) -> int:
-        query = f"""
-        [out:json][timeout:25];
-        (
-          node(around:{radius_m},{lat_key},{lon_key})[{filter_expr}];
-          way(around:{radius_m},{lat_key},{lon_key})[{filter_expr}];
-          relation(around:{radius_m},{lat_key},{lon_key})[{filter_expr}];
-        );
-        out ids;
-        """
-        data = request_json(
-            "POST",
-            overpass_url,
-            data=query.encode("utf-8"),
-            timeout=35,
-            limiter=_overpass_limiter,
-        )
-        return len(data.get("elements", []))
+    index = _indexes.get("poi")
+    if index is not None and _bbox_covers(_POI_SNAPSHOT_BBOX, lat_key, lon_key, radius_m):
+        found = Counter(index.query(lat_key, lon_key, radius_m))
+        return {name: found.get(name, 0) for name, _, _ in _POI_CATEGORIES}
+
+    query = _POI_COUNT_QUERY.format(around=f"around:{radius_m},{lat_key},{lon_key}")
 
+    data = await overpass_query(query, timeout=35)
+
+    # 每个 `out count;` 按顺序输出一个 type=count 的元素，总数在 tags.total
+    counts = [e for e in data.elements if e.type == "count"]
+    if len(counts) != len(_POI_CATEGORIES):
+        raise ApiError(f"Unexpected Overpass count output: {len(counts)} elements")
     return {
-        "restaurants": count_for('"amenity"="restaurant"'),
-        "bars": count_for('"amenity"="bar"'),
-        "cafes": count_for('"amenity"="cafe"'),
-        "shops": count_for("shop"),
+        name: int(c.tags.get("total") or 0)
+        for (name, _, _), c in zip(_POI_CATEGORIES, counts)
     }
 
 
@@ -195,68 +848,132 @@ def poi_counts(lat_key: float, lon_key: float, radius_m: int) -> Dict[str, Any]:
 # -----------------------------
 _crime_limiter = RateLimiter(calls=6, period_sec=1.0)
 
+_CRIME_URL = "https://arcgisportal.baltimorepolice.org/gis/rest/services/Crime/Public_Crime_Map_Last3Months/FeatureServer/0/query"
+_CRIME_PAGE_SIZE = 2000
+_CRIME_REFRESH_SEC = 3600
+
+
+class CrimeGeometry(msgspec.Struct):
+    x: Optional[float] = None
+    y: Optional[float] = None
 
-@lru_cache(maxsize=20000)
-def crime_counts(lat_key: float, lon_key: float, radius_m: int) -> Dict[str, Any]:
+
+class CrimeAttributes(msgspec.Struct):
+    CRIME_TYPE: Optional[str] = None
+    ct: Optional[int] = None  # 只有分组统计查询才有
+
+
+class CrimeFeature(msgspec.Struct):
+    attributes: CrimeAttributes = msgspec.field(default_factory=CrimeAttributes)
+    geometry: Optional[CrimeGeometry] = None
+
+
+class ArcGISError(msgspec.Struct):
+    code: Optional[int] = None
+    message: str = ""
+
+
+class CrimeResponse(msgspec.Struct):
+    # 快照分页时几千条 feature：按类型解码只取这几个字段，不为每条建 dict
+    features: List[CrimeFeature] = []
+    exceededTransferLimit: bool = False
+    # ArcGIS 查询出错时照样回 HTTP 200，错误放在 body 的 error 里
+    error: Optional[ArcGISError] = None
+
+
+async def _crime_query(params: Dict[str, str], timeout: float) -> CrimeResponse:
+    data = await request_json(
+        "GET", _CRIME_URL, params=params, timeout=timeout, limiter=_crime_limiter, decode_as=CrimeResponse
+    )
+    if data.error is not None:
+        raise ApiError(f"ArcGIS error {data.error.code}: {data.error.message[:200]}", status=data.error.code)
+    return data
+
+# 分组统计查询里不随坐标变化的部分，模块加载时构建一次；每次只补 geometry / distance
+_CRIME_OUT_STATS = '[{"statisticType":"count","onStatisticField":"OBJECTID","outStatisticFieldName":"ct"}]'
+_CRIME_GROUPBY_PARAMS = {
+    "where": "1=1",
+    "geometryType": "esriGeometryPoint",
+    "inSR": "4326",
+    "spatialRel": "esriSpatialRelIntersects",
+    "units": "esriSRUnit_Meter",
+    "groupByFieldsForStatistics": "CRIME_TYPE",
+    "outStatistics": _CRIME_OUT_STATS,
+    "outFields": "CRIME_TYPE",
+    "returnGeometry": "false",
+    "f": "json",
+}
+
+
+async def _load_crime_index() -> PointIndex:
+    """
+    分页拉取整个图层（近三个月、Baltimore 市内）的点位 + CRIME_TYPE，建本地索引。
+    """
+    points: List[Tuple[float, float, str]] = []
+    offset = 0
+    while True:
+        params = {
+            "where": "1=1",
+            "outFields": "CRIME_TYPE",
+            "returnGeometry": "true",
+            "outSR": "4326",
+            "orderByFields": "OBJECTID",
+            "resultOffset": str(offset),
+            "resultRecordCount": str(_CRIME_PAGE_SIZE),
+            "f": "json",
+        }
+        data = await _crime_query(params, timeout=60)
+        for f in data.features:
+            g = f.geometry
+            if g is None or g.x is None or g.y is None:
+                continue
+            points.append((g.y, g.x, f.attributes.CRIME_TYPE or "UNKNOWN"))
+        if not data.features or not data.exceededTransferLimit:
+            break
+        offset += len(data.features)
+
+    # 建索引是纯 CPU，放线程里别卡事件循环
+    return await asyncio.to_thread(PointIndex, points)
+
+
+@async_cached(maxsize=20000, ttl=900, max_bytes=32 * 2**20)  # by_type 长短不一，市中心一格能有几十类
+@shared_cached("crime", ttl=900)  # 犯罪数据按 15 分钟刷新
+async def crime_counts(lat_key: float, lon_key: float, radius_m: int) -> Dict[str, Any]:
     """
     近三个月公共犯罪地图（ArcGIS FeatureServer）。
     返回：总数 + 按 CRIME_TYPE 分组统计。
+    本地快照已加载时直接查内存索引，否则回退到远端分组统计查询。
     """
-    base = "https://arcgisportal.baltimorepolice.org/gis/rest/services/Crime/Public_Crime_Map_Last3Months/FeatureServer/0/query"
+    index = _indexes.get("crime")
+    if index is not None:
+        by_type = dict(Counter(index.query(lat_key, lon_key, radius_m)))
+        return {"total_last_3mo": sum(by_type.values()), "by_type": by_type}
 
-    # 1) 总数
-    params_total = {
-        "where": "1=1",
-        "geometry": f"{lon_key},{lat_key}",
-        "geometryType": "esriGeometryPoint",
-        "inSR": "4326",
-        "spatialRel": "esriSpatialRelIntersects",
-        "distance": str(radius_m),
-        "units": "esriSRUnit_Meter",
-        "returnCountOnly": "true",
-        "f": "json",
-    }
-    total_data = request_json("GET", base, params=params_total, timeout=25, limiter=_crime_limiter)
-    total = int(total_data.get("count") or 0)
-
-    # 2) 分类型统计
-    out_stats = json.dumps(
-        [{
-            "statisticType": "count",
-            "onStatisticField": "OBJECTID",
-            "outStatisticFieldName": "ct",
-        }]
-    )
+    # 图层只有市内记录，查询圆碰不到市界就一定是 0，不用回源
+    if not _bbox_touches(_BALTIMORE_CITY_BBOX, lat_key, lon_key, radius_m):
+        return {"total_last_3mo": 0, "by_type": {}}
+
+    # 只发分组统计一次请求；总数 = 各类型计数之和，省掉一次 returnCountOnly 往返
     params_by = {
-        "where": "1=1",
+        **_CRIME_GROUPBY_PARAMS,
         "geometry": f"{lon_key},{lat_key}",
-        "geometryType": "esriGeometryPoint",
-        "inSR": "4326",
-        "spatialRel": "esriSpatialRelIntersects",
         "distance": str(radius_m),
-        "units": "esriSRUnit_Meter",
-        "groupByFieldsForStatistics": "CRIME_TYPE",
-        "outStatistics": out_stats,
-        "outFields": "CRIME_TYPE",
-        "returnGeometry": "false",
-        "f": "json",
     }
-    by_data = request_json("GET", base, params=params_by, timeout=25, limiter=_crime_limiter)
-    feats = by_data.get("features", []) or []
+    by_data = await _crime_query(params_by, timeout=25)
 
     by_type: Dict[str, int] = {}
-    for f in feats:
-        a = f.get("attributes", {}) or {}
-        k = a.get("CRIME_TYPE") or "UNKNOWN"
-        by_type[k] = int(a.get("ct") or 0)
+    for f in by_data.features:
+        k = f.attributes.CRIME_TYPE or "UNKNOWN"
+        by_type[k] = by_type.get(k, 0) + (f.attributes.ct or 0)
 
+    total = sum(by_type.values())
     return {"total_last_3mo": total, "by_type": by_type}
 
 
 # -----------------------------
 # E) Transit (MVP stub)
 # -----------------------------
-def transit_stub(lat: float, lon: float, radius_m: int) -> Dict[str, Any]:
+async def transit_stub(lat: float, lon: float, radius_m: int) -> Dict[str, Any]:
     # 先打通字段与展示；后续接入 MTA GTFS 可计算 nearest_stop_m / stops_within_radius
     return {
         "nearest_stop_m": None,
@@ -268,308 +985,337 @@ def transit_stub(lat: float, lon: float, radius_m: int) -> Dict[str, Any]:
 # -----------------------------
 # API endpoint: features
 # -----------------------------
-@app.get("/api/features")
-def api_features(
-    lat: float = Query(...),
-    lon: float = Query(...),
-    radius: int = Query(500, ge=100, le=2000),
-):
-    lat_k, lon_k = _round_key(lat, lon, ndigits=3)
-    notes: Dict[str, str] = {}
-
-    geo, note = safe_call(lambda: census_geographies(lat_k, lon_k), {})
+async def _census_chain(lat_k: float, lon_k: float, notes: Dict[str, str]) -> Dict[str, Any]:
+    # geo -> ACS 有依赖，只能串行；但整条链与 POI / crime 并发
+    geo, note = await safe_call(lambda: census_geographies(lat_k, lon_k), {})
     if note:
         notes["census_geo"] = note
 
     census = dict(geo)
     if geo:
-        acs, note = safe_call(lambda: acs_features(geo["state_fips"], geo["county_fips"], geo["tract"]), {})
+        acs, note = await safe_call(lambda: acs_features(geo["state_fips"], geo["county_fips"], geo["tract"]), {})
         if note:
             notes["census_acs"] = note
         census.update(acs)
+    return census
+
+
+# 启动预热：Baltimore 市中心周围 20x20 个相邻的 census 网格瓦片（与 _round_key 同一网格），
+# 先把最慢的 census geocoder + ACS 链路灌进缓存；POI / crime 已有本地快照，不需要预热
+_WARM_CENTER = (39.2904, -76.6122)
+_WARM_STEPS = 20
+_WARM_CONCURRENCY = 4
+_WARM_PACE_SEC = 1.0  # 每个并发槽每秒最多预热一格，给真实 hover 留一半限流额度
+
+
+async def _warm_tiles() -> None:
+    sem = asyncio.Semaphore(_WARM_CONCURRENCY)
+
+    async def warm_one(z: int, x: int, y: int) -> None:
+        async with sem:
+            lat_k, lon_k = _tile_center(z, x, y)
+            await _census_chain(lat_k, lon_k, {})
+            await asyncio.sleep(_WARM_PACE_SEC)
+
+    z, x0, y0 = _grid_cell(*_WARM_CENTER)
+    half = _WARM_STEPS // 2
+    await asyncio.gather(*(
+        warm_one(z, x0 + i, y0 + j)
+        for i in range(-half, _WARM_STEPS - half)
+        for j in range(-half, _WARM_STEPS - half)
+    ))
+    logger.info("warmed %d census cells", _WARM_STEPS * _WARM_STEPS)
+
+
+# hover 之后顺手预取周围 8 个网格（与 _round_key 同一网格）：鼠标下一步大概率落在相邻格
+# 只在缓存未命中、且对应限流器当前空闲时才回源，不跟前台 hover 抢额度
+_PREFETCH_CONCURRENCY = 4
+_prefetch_sem = asyncio.Semaphore(_PREFETCH_CONCURRENCY)
+
+
+def _neighbor_keys(lat: float, lon: float, radius_m: int) -> List[Tuple[float, float]]:
+    z, x, y = _grid_cell(lat, lon, radius_m)
+    return [_tile_center(z, x + i, y + j) for i in (-1, 0, 1) for j in (-1, 0, 1) if i or j]
+
+
+async def prefetch_neighbors(lat: float, lon: float, radius_k: int) -> None:
+    _prefetching.set(True)  # 只影响本 task 的 context
+
+    async def run(ready, fn) -> None:
+        # 排队等 _prefetch_sem 期间额度可能已被前台用掉、缓存也可能已被填上：开跑前再看一次。
+        # 这只是省事的预筛；真正的把关在 request_json 里（预取对限流器只 try_acquire，不排队）
+        async with _prefetch_sem:
+            if ready():
+                await safe_call(fn, None)
+
+    poi_local = "poi" in _indexes and _bbox_covers(_POI_SNAPSHOT_BBOX, lat, lon, radius_k)
+    crime_local = "crime" in _indexes
+
+    jobs = []
+    for lat_k, lon_k in _neighbor_keys(lat, lon, 500):
+        jobs.append(run(
+            lambda key=(lat_k, lon_k): (
+                key not in census_geographies.cache and _census_limiter.idle() and _acs_limiter.idle()
+            ),
+            lambda lat_k=lat_k, lon_k=lon_k: _census_chain(lat_k, lon_k, {}),
+        ))
+    for lat_k, lon_k in _neighbor_keys(lat, lon, radius_k):
+        args = (lat_k, lon_k, radius_k)
+        jobs.append(run(
+            lambda args=args: (
+                args not in poi_counts.cache
+                and (poi_local or any(l.idle() for l in _overpass_limiters.values()))
+            ),
+            lambda args=args: poi_counts(*args),
+        ))
+        jobs.append(run(
+            lambda args=args: args not in crime_counts.cache and (crime_local or _crime_limiter.idle()),
+            lambda args=args: crime_counts(*args),
+        ))
+    await asyncio.gather(*jobs)
+
+
+def _spawn_prefetch(lat: float, lon: float, radius_k: int) -> None:
+    _detach(asyncio.create_task(prefetch_neighbors(lat, lon, radius_k)))
+
+
+def _census_stale(lat_k: float, lon_k: float) -> Any:
+    geo = census_geographies.stale(lat_k, lon_k)
+    if geo is _MISSING:
+        return _MISSING
+    census = dict(geo)
+    if geo:
+        acs = acs_features.stale(geo["state_fips"], geo["county_fips"], geo["tract"])
+        if acs is not _MISSING:
+            census.update(acs)
+    return census
 
-    poi_default = {"restaurants": None, "bars": None, "cafes": None, "shops": None}
-    poi, note = safe_call(lambda: poi_counts(lat_k, lon_k, radius), poi_default)
-    if note:
-        notes["poi"] = note
 
-    crime_default = {"total_last_3mo": None, "by_type": {}}
-    crime, note = safe_call(lambda: crime_counts(lat_k, lon_k, radius), crime_default)
-    if note:
-        notes["crime"] = note
+# 各分支的响应时限（秒）
+_CENSUS_TIMEOUT_SEC = 3
+_POI_TIMEOUT_SEC = 4
+_CRIME_TIMEOUT_SEC = 4
 
-    transit, note = safe_call(lambda: transit_stub(lat, lon, radius), {"nearest_stop_m": None, "stops_within_radius": None})
-    if note:
-        notes["transit"] = note
-
-    return JSONResponse(
-        {
-            "lat": lat,
-            "lon": lon,
-            "radius_m": radius,
-            "census": census,
-            "poi": poi,
-            "crime": crime,
-            "transit": transit,
-            "notes": notes,  # ✅ 如果某个源失败，这里会显示原因
+
+_POI_DEFAULT = {"restaurants": None, "bars": None, "cafes": None, "shops": None}
+_CRIME_DEFAULT = {"total_last_3mo": None, "by_type": {}}
+_TRANSIT_DEFAULT = {"nearest_stop_m": None, "stops_within_radius": None}
+
+
+async def _ready(value: Any) -> Tuple[Any, Optional[str]]:
+    return value, None
+
+
+def _feature_sources(
+    lat: float, lon: float, radius: int, notes: Dict[str, str]
+) -> Dict[str, Callable[[], Awaitable[Tuple[Any, Optional[str]]]]]:
+    """
+    各数据源的 safe_call，按响应里的字段顺序排列；调用方决定怎么并发（一次性汇总 / 逐个推送）。
+    区域外直接返回默认值，不碰任何上游。
+    """
+    if not _bbox_contains(_METRO_BBOX, lat, lon):
+        notes["region"] = "out of supported area"
+        return {
+            "census": lambda: _ready({}),
+            "poi": lambda: _ready(_POI_DEFAULT),
+            "crime": lambda: _ready(_CRIME_DEFAULT),
+            "transit": lambda: _ready(_TRANSIT_DEFAULT),
         }
-    )
 
+    # census 按点所在 tract 取值，始终用最细网格；POI / crime 是半径统计，网格随半径放粗、半径分桶
+    census_lat_k, census_lon_k = _round_key(lat, lon)
+    radius_k = _radius_bucket(radius)
+    lat_k, lon_k = _round_key(lat, lon, radius_k)
 
-# -----------------------------
-# Frontend page (Leaflet)
-# -----------------------------
-INDEX_HTML = """
-<!doctype html>
-<html>
-<head>
-  <meta charset="utf-8" />
-  <title>SmallBiz Map Hover MVP</title>
-  <meta name="viewport" content="width=device-width, initial-scale=1.0" />
-
-  <link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css"/>
-  <style>
-    html, body { height: 100%; margin: 0; }
-    #wrap { display: flex; height: 100%; }
-    #map { flex: 1; }
-    #panel {
-      width: 420px; padding: 14px; font-family: Arial, sans-serif;
-      border-left: 1px solid #ddd; overflow: auto;
-      background: #fafafa;
-    }
-    .muted { color: #666; font-size: 12px; }
-    .card {
-      background: #fff; border: 1px solid #eee; border-radius: 10px;
-      padding: 12px; margin: 10px 0;
-      box-shadow: 0 1px 2px rgba(0,0,0,0.04);
-    }
-    .card h3 { margin: 0 0 10px 0; font-size: 14px; }
-    table.kv { width: 100%; border-collapse: collapse; font-size: 13px; }
-    table.kv td { padding: 6px 4px; vertical-align: top; border-top: 1px solid #f2f2f2; }
-    table.kv td.key { width: 55%; color: #333; }
-    table.kv td.val { text-align: right; color: #111; font-weight: 600; }
-    ul { margin: 6px 0 0 18px; padding: 0; }
-    li { margin: 4px 0; font-size: 13px; }
-    .warn { color: #b00020; font-size: 12px; white-space: pre-wrap; word-break: break-word; }
-    .ok { color: #0b6b0b; font-size: 12px; }
-  </style>
-</head>
-<body>
-<div id="wrap">
-  <div id="map"></div>
-  <div id="panel">
-    <h2 style="margin:0 0 6px 0;">Hover Data</h2>
-    <div id="meta" class="muted">Move mouse on map...</div>
-
-    <div id="content"></div>
-    <div id="errors" class="warn"></div>
-  </div>
-</div>
-
-<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
-<script>
-  const map = L.map('map').setView([39.2904, -76.6122], 13); // Baltimore
-  L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
-    maxZoom: 19,
-    attribution: '&copy; OpenStreetMap contributors'
-  }).addTo(map);
-
-  let timer = null;
-  let lastKey = null;
-
-  function fmtNA(v) {
-    if (v === null || v === undefined) return "N/A";
-    return String(v);
-  }
-  function fmtInt(v) {
-    if (v === null || v === undefined) return "N/A";
-    const n = Number(v);
-    if (Number.isNaN(n)) return "N/A";
-    return n.toLocaleString();
-  }
-  function fmtMoney(v) {
-    if (v === null || v === undefined) return "N/A";
-    const n = Number(v);
-    if (Number.isNaN(n)) return "N/A";
-    return "$" + n.toLocaleString();
-  }
-
-  function makeCard(title, rows) {
-    const card = document.createElement("div");
-    card.className = "card";
-
-    const h = document.createElement("h3");
-    h.textContent = title;
-    card.appendChild(h);
-
-    const table = document.createElement("table");
-    table.className = "kv";
-
-    for (const [k, v] of rows) {
-      const tr = document.createElement("tr");
-
-      const tdK = document.createElement("td");
-      tdK.className = "key";
-      tdK.textContent = k;
-
-      const tdV = document.createElement("td");
-      tdV.className = "val";
-      tdV.textContent = v;
-
-      tr.appendChild(tdK);
-      tr.appendChild(tdV);
-      table.appendChild(tr);
+    # 每个分支单独限时，慢的上游不再决定整体延迟；超时的回源仍在后台跑完并写缓存
+    return {
+        "census": lambda: safe_call(
+            lambda: _census_chain(census_lat_k, census_lon_k, notes), {},
+            timeout=_CENSUS_TIMEOUT_SEC, stale=lambda: _census_stale(census_lat_k, census_lon_k),
+        ),
+        "poi": lambda: safe_call(
+            lambda: poi_counts(lat_k, lon_k, radius_k), _POI_DEFAULT,
+            timeout=_POI_TIMEOUT_SEC, stale=lambda: poi_counts.stale(lat_k, lon_k, radius_k),
+        ),
+        "crime": lambda: safe_call(
+            lambda: crime_counts(lat_k, lon_k, radius_k), _CRIME_DEFAULT,
+            timeout=_CRIME_TIMEOUT_SEC, stale=lambda: crime_counts.stale(lat_k, lon_k, radius_k),
+        ),
+        "transit": lambda: safe_call(lambda: transit_stub(lat, lon, radius), _TRANSIT_DEFAULT),
     }
 
-    card.appendChild(table);
-    return card;
-  }
-
-  function renderFeatures(j) {
-    const content = document.getElementById("content");
-    const errors = document.getElementById("errors");
-    content.innerHTML = "";
-    errors.textContent = "";
-
-    // Census
-    const c = j.census || {};
-    content.appendChild(makeCard("Census (Population & Income)", [
-      ["Population", fmtInt(c.population)],
-      ["Median Household Income", fmtMoney(c.median_household_income)],
-      ["State FIPS", fmtNA(c.state_fips)],
-      ["County FIPS", fmtNA(c.county_fips)],
-      ["Tract", fmtNA(c.tract)],
-    ]));
-
-    // POI
-    const p = j.poi || {};
-    content.appendChild(makeCard("POI Density (within radius)", [
-      ["Restaurants", fmtInt(p.restaurants)],
-      ["Bars", fmtInt(p.bars)],
-      ["Cafes", fmtInt(p.cafes)],
-      ["Shops", fmtInt(p.shops)],
-    ]));
-
-    // Crime
-    const crime = j.crime || {};
-    const totalCrime = crime.total_last_3mo;
-    const cardCrime = document.createElement("div");
-    cardCrime.className = "card";
-
-    const h = document.createElement("h3");
-    h.textContent = "Crime (last 3 months)";
-    cardCrime.appendChild(h);
-
-    const table = document.createElement("table");
-    table.className = "kv";
-    const tr = document.createElement("tr");
-    const tdK = document.createElement("td");
-    tdK.className = "key";
-    tdK.textContent = "Total incidents";
-    const tdV = document.createElement("td");
-    tdV.className = "val";
-    tdV.textContent = fmtInt(totalCrime);
-    tr.appendChild(tdK);
-    tr.appendChild(tdV);
-    table.appendChild(tr);
-    cardCrime.appendChild(table);
-
-    // Top types
-    const byType = crime.by_type || {};
-    const entries = Object.entries(byType).sort((a,b) => (b[1]||0) - (a[1]||0)).slice(0, 8);
-    if (entries.length > 0) {
-      const sub = document.createElement("div");
-      sub.className = "muted";
-      sub.style.marginTop = "8px";
-      sub.textContent = "Top types:";
-      cardCrime.appendChild(sub);
-
-      const ul = document.createElement("ul");
-      for (const [t, ct] of entries) {
-        const li = document.createElement("li");
-        li.textContent = `${t}: ${fmtInt(ct)}`;
-        ul.appendChild(li);
-      }
-      cardCrime.appendChild(ul);
-    }
-    content.appendChild(cardCrime);
-
-    // Transit
-    const t = j.transit || {};
-    content.appendChild(makeCard("Transit (MVP)", [
-      ["Nearest stop (m)", fmtInt(t.nearest_stop_m)],
-      ["Stops within radius", fmtInt(t.stops_within_radius)],
-      ["Note", fmtNA(t.note)],
-    ]));
-
-    // Notes (API failures / rate limits)
-    const notes = j.notes || {};
-    const noteKeys = Object.keys(notes);
-    if (noteKeys.length > 0) {
-      const noteCard = document.createElement("div");
-      noteCard.className = "card";
-
-      const nh = document.createElement("h3");
-      nh.textContent = "Notes (data source issues)";
-      noteCard.appendChild(nh);
-
-      const ul = document.createElement("ul");
-      for (const k of noteKeys) {
-        const li = document.createElement("li");
-        li.textContent = `${k}: ${notes[k]}`;
-        ul.appendChild(li);
-      }
-      noteCard.appendChild(ul);
-
-      content.appendChild(noteCard);
-    }
-  }
 
-  async function fetchFeatures(lat, lon) {
-    const radius = 500;
+_DISCONNECT_POLL_SEC = 0.2
 
-    // 网格化：减少重复请求
-    const key = `${lat.toFixed(3)},${lon.toFixed(3)},${radius}`;
-    if (key === lastKey) return;
-    lastKey = key;
 
-    document.getElementById('meta').innerText =
-      `lat=${lat.toFixed(5)}, lon=${lon.toFixed(5)}, r=${radius}m`;
+async def _cancel_on_disconnect(request: Request, tasks: Iterable[asyncio.Task]) -> None:
+    # 用户已经移到别处、连接断了：不必再等上游，取消剩下的分支（没人等的回源也随之取消）
+    while not await request.is_disconnected():
+        await asyncio.sleep(_DISCONNECT_POLL_SEC)
+    for task in tasks:
+        task.cancel()
 
-    try {
-      const res = await fetch(`/api/features?lat=${lat}&lon=${lon}&radius=${radius}`);
-      const text = await res.text();
 
-      if (!res.ok) {
-        document.getElementById('errors').textContent = `HTTP ${res.status}\\n${text}`;
-        return;
-      }
+# 整个响应（回显的 lat / lon / radius_m 除外）按网格缓存成字节：JSON 一份、拼好的 SSE 事件流一份，
+# 两个端点共用。同一格反复 hover 时不再走 safe_call、不再拼 dict、不再序列化。key 同时含 census 网格和 POI / crime 网格（大半径时两者粗细不同）；
+# transit 目前是常量桩，按格缓存没问题。有数据源失败的结果不进缓存，下次照常回源补齐。
+_PAYLOAD_CACHE_TTL_SEC = 600
+_payload_cache = AsyncTTLCache(maxsize=50000, ttl=_PAYLOAD_CACHE_TTL_SEC, max_bytes=64 * 2**20)
 
-      const j = JSON.parse(text);
-      renderFeatures(j);
-    } catch (e) {
-      document.getElementById('errors').textContent = String(e);
-    }
-  }
 
-  function debounce(lat, lon) {
-    if (timer) clearTimeout(timer);
-    timer = setTimeout(() => fetchFeatures(lat, lon), 300);
-  }
+def _payload_key(lat: float, lon: float, radius: int) -> Tuple[float, float, float, float, int]:
+    radius_k = _radius_bucket(radius)
+    return (*_round_key(lat, lon), *_round_key(lat, lon, radius_k), radius_k)
+
+
+def _sse(event: str, data: Any) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+
+def _payload_entry(body: Dict[str, Any]) -> Tuple[bytes, bytes]:
+    # body 按响应字段顺序排列、notes 在最后；SSE 事件流按同样顺序，notes 仍是最后一个事件
+    return orjson.dumps(body), b"".join(_sse(name, value) for name, value in body.items())
+
+
+@app.get("/api/features")
+async def api_features(
+    request: Request,
+    lat: float = Query(...),
+    lon: float = Query(...),
+    radius: int = Query(500, ge=100, le=2000),
+):
+    in_area = _bbox_contains(_METRO_BBOX, lat, lon)
+    cache_key = _payload_key(lat, lon, radius) if in_area else None
+    cached = _payload_cache.get(cache_key) if in_area else None
+    failed = False
+
+    if cached is None:
+        notes: Dict[str, str] = {}
+        sources = _feature_sources(lat, lon, radius, notes)
+
+        async with asyncio.TaskGroup() as tg:
+            tasks = {name: tg.create_task(call()) for name, call in sources.items()}
+            watcher = asyncio.create_task(_cancel_on_disconnect(request, tasks.values()))
+        watcher.cancel()
+        if any(task.cancelled() for task in tasks.values()):
+            return Response(status_code=499)  # client closed request
+
+        body: Dict[str, Any] = {}
+        for name, task in tasks.items():
+            body[name], note = task.result()
+            if note:
+                notes[name] = note
+        body["notes"] = notes  # ✅ 如果某个源失败，这里会显示原因
+
+        cached = _payload_entry(body)
+        failed = any(k != "region" for k in notes)
+        if in_area:
+            if not failed:
+                _payload_cache.set(cache_key, cached)
+            _spawn_prefetch(lat, lon, cache_key[-1])
+
+    # 回显的请求参数 + 各源结果直接拼字节：'{"lat":..,"lon":..,"radius_m":..' + ',' + '"census":..}'
+    content = orjson.dumps({"lat": lat, "lon": lon, "radius_m": radius})[:-1] + b"," + cached[0][1:]
+
+    # 同一 URL 再次请求时浏览器带 If-None-Match，内容没变就回 304、不传正文；
+    # 有数据源失败（notes 里除了 region 还有别的）的结果不让浏览器缓存，下次重新取
+    etag = _etag(content)
+    headers = {"ETag": etag, "Cache-Control": "no-store" if failed else "public, max-age=300"}
+    if in_area:
+        # CDN 按瓦片打标签，数据更新时可以按区域整片清掉
+        headers["Surrogate-Key"] = "tile-{}-{}-{}".format(*_grid_cell(lat, lon, cache_key[-1]))
+
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content, media_type="application/json", headers=headers)
+
+
+@app.get("/api/features/stream")
+async def api_features_stream(
+    lat: float = Query(...),
+    lon: float = Query(...),
+    radius: int = Query(500, ge=100, le=2000),
+):
+    """
+    与 /api/features 同样的数据，用 Server-Sent Events 逐个推送：哪个源先好就先发哪张卡片，
+    事件名即字段名（census / poi / crime / transit）；notes 固定最后一个发，前端收到后关闭连接。
+    整格命中 _payload_cache 时一次写出缓存里拼好的全部事件。
+    """
+    headers = {"Cache-Control": "no-cache"}
+    in_area = _bbox_contains(_METRO_BBOX, lat, lon)
+    cache_key = _payload_key(lat, lon, radius) if in_area else None
+    cached = _payload_cache.get(cache_key) if in_area else None
+    if cached is not None:
+        return Response(cached[1], media_type="text/event-stream", headers=headers)
+
+    notes: Dict[str, str] = {}
+    sources = _feature_sources(lat, lon, radius, notes)
+
+    async def named(name: str, call) -> Tuple[str, Any, Optional[str]]:
+        value, note = await call()
+        return name, value, note
 
-  map.on('mousemove', (e) => debounce(e.latlng.lat, e.latlng.lng));
-</script>
-</body>
-</html>
-"""
+    async def events():
+        values: Dict[str, Any] = {}
+        tasks = [asyncio.ensure_future(named(name, call)) for name, call in sources.items()]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                name, value, note = await next_done
+                values[name] = value
+                if note:
+                    notes[name] = note
+                yield _sse(name, value)
+        finally:
+            # 客户端断开时 Starlette 会取消这个生成器：剩下的分支一起取消
+            for task in tasks:
+                task.cancel()
+        yield _sse("notes", notes)
+        if in_area:
+            if not any(k != "region" for k in notes):
+                body = {name: values[name] for name in sources}
+                body["notes"] = notes
+                _payload_cache.set(cache_key, _payload_entry(body))
+            _spawn_prefetch(lat, lon, cache_key[-1])
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+
+# -----------------------------
+# Frontend page (Leaflet)
+# -----------------------------
+# 页面是静态文件：启动时读一次，原文 / gzip 两份字节和 ETag 都预先算好，请求时不再读盘、不再压缩
+_INDEX_PATH = Path(__file__).parent / "static" / "index.html"
+_INDEX_BYTES = _INDEX_PATH.read_bytes()
+_INDEX_GZIP = gzip.compress(_INDEX_BYTES, compresslevel=9)
+_INDEX_ETAG = _etag(_INDEX_BYTES)
+_INDEX_HEADERS = {"Cache-Control": "public, max-age=3600", "ETag": _INDEX_ETAG, "Vary": "Accept-Encoding"}
 
 
 @app.get("/", response_class=HTMLResponse)
-def index():
-    return INDEX_HTML
+def index(request: Request):
+    # 缓存过期后浏览器带 If-None-Match 来验证：页面没变就只回 304，不传正文
+    if _etag_matches(request, _INDEX_ETAG):
+        return Response(status_code=304, headers=_INDEX_HEADERS)
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        return Response(_INDEX_GZIP, media_type="text/html", headers={**_INDEX_HEADERS, "Content-Encoding": "gzip"})
+    return Response(_INDEX_BYTES, media_type="text/html", headers=_INDEX_HEADERS)
 
 
 @app.get("/health")
 def health():
-    return {"status": "ok"}
+    # 各进程内缓存的条目数 / 占用字节，给监控报警用
+    caches = {
+        "census_geo": census_geographies.cache,
+        "acs": acs_features.cache,
+        "poi": poi_counts.cache,
+        "crime": crime_counts.cache,
+        "payload": _payload_cache,
+    }
+    return {
+        "status": "ok",
+        "caches": {
+            name: {"entries": len(cache), "bytes": cache.total_bytes, "max_bytes": cache.max_bytes}
+            for name, cache in caches.items()
+        },
+    }
 
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# main 在 import 时就会打开 diskcache：指到临时目录，别往仓库里写
+os.environ.setdefault("SMALLBIZ_CACHE_DIR", tempfile.mkdtemp(prefix="smallbiz-test-"))
+os.environ.pop("REDIS_URL", None)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,208 @@
+import asyncio
+
+import pytest
+
+from main import AsyncTTLCache, _prefetching, safe_call
+
+
+def test_clock_gives_referenced_entries_a_second_chance():
+    cache = AsyncTTLCache(maxsize=3)
+    for key in "abc":
+        cache.set(key, key)
+
+    # 三个都被引用过：指针绕一圈清掉引用位，淘汰第一个
+    cache.set("d", "d")
+    assert "a" not in cache
+    assert all(k in cache for k in "bcd")
+
+    # b 命中后引用位重新置 1，下一次淘汰跳过它，轮到 c
+    assert cache.get("b") == "b"
+    cache.set("e", "e")
+    assert "b" in cache
+    assert "c" not in cache
+    assert len(cache) == 3
+
+
+def test_low_priority_entries_are_evicted_first():
+    cache = AsyncTTLCache(maxsize=3)
+    cache.set("a", 1)
+    cache.set("prefetched", 2, low_priority=True)
+    cache.set("b", 3)
+
+    cache.set("c", 4)
+    assert "prefetched" not in cache
+    assert all(k in cache for k in ("a", "b", "c"))
+
+
+def test_low_priority_entry_is_promoted_by_a_hit():
+    cache = AsyncTTLCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("prefetched", 2, low_priority=True)
+    assert cache.get("prefetched") == 2
+
+    cache.set("b", 3)
+    # 两个都有引用位：绕一圈后按槽位顺序淘汰 a，命中过的预取条目留下
+    assert "prefetched" in cache
+    assert "a" not in cache
+
+
+def test_expired_entry_is_a_miss_but_still_stale_readable():
+    cache = AsyncTTLCache(maxsize=2, ttl=-1)
+    cache.set("a", 1)
+    assert cache.get("a", "miss") == "miss"
+    assert "a" not in cache
+    assert cache.get_stale("a") == 1
+
+
+def test_byte_cap_evicts_until_within_budget():
+    cache = AsyncTTLCache(maxsize=100, max_bytes=80)
+    for i in range(20):
+        cache.set(i, b"x" * 10)
+        assert cache.total_bytes <= 80
+    assert len(cache) == 8
+    assert 19 in cache
+
+
+def test_byte_cap_refuses_oversized_values():
+    cache = AsyncTTLCache(maxsize=100, max_bytes=80)
+    cache.set("small", b"x" * 10)
+    cache.set("huge", b"y" * 200)
+    assert "huge" not in cache
+    assert "small" in cache
+    assert cache.total_bytes == 10
+
+    # 已有的 key 被写入超大值：旧值作废，槽位回收
+    cache.set("small", b"z" * 50)
+    assert "small" not in cache
+    assert cache.total_bytes == 0
+    cache.set("next", b"n" * 5)
+    assert cache.get("next") == b"n" * 5
+
+
+def test_single_flight_shares_one_fetch():
+    async def main():
+        cache = AsyncTTLCache(maxsize=10)
+        calls = 0
+
+        async def fetch():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return 42
+
+        results = await asyncio.gather(*(cache.get_or_fetch("k", fetch) for _ in range(5)))
+        assert results == [42] * 5
+        assert calls == 1
+        assert await cache.get_or_fetch("k", fetch) == 42
+        assert calls == 1
+
+    asyncio.run(main())
+
+
+def test_failed_fetch_is_not_cached():
+    async def main():
+        cache = AsyncTTLCache(maxsize=10)
+        outcomes = iter([RuntimeError("boom"), 7])
+
+        async def fetch():
+            outcome = next(outcomes)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        with pytest.raises(RuntimeError):
+            await cache.get_or_fetch("k", fetch)
+        assert await cache.get_or_fetch("k", fetch) == 7
+
+    asyncio.run(main())
+
+
+def _slow_fetch(started, cancelled, delay=0.2):
+    async def fetch():
+        started.append(1)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+        return "done"
+
+    return fetch
+
+
+def test_last_cancelled_waiter_cancels_the_fill():
+    async def main():
+        cache = AsyncTTLCache(maxsize=10)
+        started, cancelled = [], []
+        waiter = asyncio.create_task(cache.get_or_fetch("k", _slow_fetch(started, cancelled)))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        await asyncio.sleep(0)
+
+        assert cancelled == [1]
+        assert "k" not in cache
+        assert not cache._inflight and not cache._waiters
+
+        # 之后的请求重新回源，而不是接上被取消的那次
+        assert await cache.get_or_fetch("k", _slow_fetch(started, cancelled, 0)) == "done"
+        assert len(started) == 2
+
+    asyncio.run(main())
+
+
+def test_cancelling_one_of_two_waiters_keeps_the_fill():
+    async def main():
+        cache = AsyncTTLCache(maxsize=10)
+        started, cancelled = [], []
+        fetch = _slow_fetch(started, cancelled)
+        first = asyncio.create_task(cache.get_or_fetch("k", fetch))
+        second = asyncio.create_task(cache.get_or_fetch("k", fetch))
+        await asyncio.sleep(0.01)
+        first.cancel()
+
+        assert await second == "done"
+        assert cancelled == []
+        assert started == [1]
+        assert cache.get("k") == "done"
+
+    asyncio.run(main())
+
+
+def test_safe_call_timeout_lets_the_fill_finish():
+    async def main():
+        cache = AsyncTTLCache(maxsize=10)
+        started, cancelled = [], []
+        value, note = await safe_call(
+            lambda: cache.get_or_fetch("k", _slow_fetch(started, cancelled, 0.05)), "default", timeout=0.01
+        )
+        assert value == "default"
+        assert note.startswith("TimeoutError")
+
+        await asyncio.sleep(0.1)
+        assert cancelled == []
+        assert cache.get("k") == "done"
+
+    asyncio.run(main())
+
+
+def test_prefetch_fill_is_stored_low_priority():
+    async def main():
+        cache = AsyncTTLCache(maxsize=2)
+        cache.set("a", 1)
+
+        async def prefetch():
+            _prefetching.set(True)
+
+            async def fetch():
+                return 2
+
+            await cache.get_or_fetch("prefetched", fetch)
+
+        await asyncio.create_task(prefetch())
+        cache.set("b", 3)
+        assert "prefetched" not in cache
+        assert "a" in cache
+
+    asyncio.run(main())